@@ -1,7 +1,12 @@
 import streamlit as st
 import pandas as pd
-from sqlalchemy import create_engine, text
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from sqlalchemy import create_engine, text, types
 from datetime import datetime
+import csv
+import io
 import os
 import re
 
@@ -25,13 +30,28 @@ def init_connection():
             st.error("❌ Configure DATABASE_URL nas variáveis de ambiente ou secrets")
             st.stop()
     
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=10,
+        max_overflow=20,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        # LIFO reaproveita as conexões mais quentes e deixa as ociosas expirarem
+        pool_use_lifo=True,
+        # Modo rápido de executemany do psycopg2 para os INSERTs fora do caminho COPY
+        executemany_mode='values_plus_batch',
+        executemany_values_page_size=1000,
+        executemany_batch_page_size=500,
+        # Identifica as sessões do dashboard em pg_stat_activity
+        connect_args={'application_name': 'dash_primecod_e_n1'},
+    )
     return engine
 
 # Funções de banco de dados para N1
-def criar_tabelas(engine):
-    """Cria tabelas necessárias no banco"""
-    with engine.connect() as conn:
+@st.cache_resource
+def criar_tabelas(_engine):
+    """Cria tabelas necessárias no banco (uma vez por processo, não por rerun)"""
+    with _engine.connect() as conn:
         # Tabela de uploads N1
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS uploads_n1 (
@@ -68,29 +88,59 @@ def criar_tabelas(engine):
                 pais VARCHAR(20)
             )
         """))
-        
+
+        # Índices para as consultas por upload/país (evita seq scan conforme a tabela cresce)
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_dados_n1_upload ON dados_n1(upload_id)
+        """))
+
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_dados_n1_upload_pais ON dados_n1(upload_id, pais)
+        """))
+
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_dados_n1_upload_status ON dados_n1(upload_id, order_status)
+        """))
+
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_dados_n1_upload_product ON dados_n1(upload_id, product_name)
+        """))
+
         conn.commit()
 
+# Valores da primeira célula que indicam um cabeçalho duplicado no Excel
+HEADER_TOKENS = frozenset({'order #', 'order', 'número pedido', ''})
+
+# Códigos de província da Espanha (2 letras)
+SPAIN_PROVINCES = frozenset({
+    'A', 'AB', 'AL', 'AV', 'B', 'BA', 'BI', 'BU', 'C', 'CA', 'CC', 'CO', 'CR',
+    'CS', 'CU', 'GC', 'GI', 'GR', 'GU', 'H', 'HU', 'J', 'L', 'LE', 'LO', 'LU',
+    'M', 'MA', 'MU', 'NA', 'O', 'OR', 'P', 'PM', 'PO', 'S', 'SA', 'SE', 'SG',
+    'SO', 'SS', 'T', 'TE', 'TF', 'TO', 'V', 'VA', 'VI', 'Z', 'ZA',
+})
+
+# Prefixos de número de pedido por país, indexados pelo tamanho da fatia
+PREFIXO_PAIS_4 = {'#ITA': 'Italia', '#ESP': 'Espanha', '#POL': 'Polonia', '#ROM': 'Romania'}
+PREFIXO_PAIS_3 = {'#ES': 'Espanha', '#PL': 'Polonia', '#RO': 'Romania'}
+PREFIXO_PAIS_2 = {'LL': 'Espanha'}
+
 def detectar_pais_por_pedido(order_number):
     """Detecta país baseado no formato do número do pedido"""
     if not order_number or pd.isna(order_number):
         return None
-    
+
     order_str = str(order_number).strip().upper()
-    
-    # Padrões de pedidos por país
-    if order_str.startswith('#ITA'):
-        return 'Italia'
-    elif order_str.startswith('LL'):
-        return 'Espanha'
-    elif order_str.startswith('#ESP') or order_str.startswith('#ES'):
-        return 'Espanha'
-    elif order_str.startswith('#POL') or order_str.startswith('#PL'):
-        return 'Polonia'
-    elif order_str.startswith('#ROM') or order_str.startswith('#RO'):
-        return 'Romania'
-    
-    return None
+
+    # Busca O(1) por prefixo, do mais específico para o mais curto
+    return (PREFIXO_PAIS_4.get(order_str[:4])
+            or PREFIXO_PAIS_3.get(order_str[:3])
+            or PREFIXO_PAIS_2.get(order_str[:2]))
+
+# Padrões de validação de número de pedido (compilados uma vez no import)
+REGEX_LETRA = re.compile(r'[a-zA-Z]')
+REGEX_NUMERO = re.compile(r'\d')
+REGEX_PEDIDO_CONHECIDO = re.compile(r'^(?:#[A-Z]{2,3}\d+|LL\d+|[A-Z]{2}\d+|\d+[A-Z]+)')
+REGEX_PEDIDO_BASICO = re.compile(r'^[A-Za-z0-9#\-_]+$')
 
 def is_valid_order_number(order_number):
     """Verifica se o número do pedido é válido"""
@@ -98,105 +148,152 @@ def is_valid_order_number(order_number):
         return False
     
     order_str = str(order_number).strip()
-    
+
     # Deve ter pelo menos 3 caracteres
     if len(order_str) < 3:
         return False
-    
+
     # Deve conter pelo menos uma letra e um número
-    has_letter = bool(re.search(r'[a-zA-Z]', order_str))
-    has_number = bool(re.search(r'\d', order_str))
-    
-    if not (has_letter and has_number):
+    if not (REGEX_LETRA.search(order_str) and REGEX_NUMERO.search(order_str)):
         return False
-    
-    # Padrões válidos conhecidos
-    valid_patterns = [
-        r'^#[A-Z]{2,3}\d+',  # #ITA123, #ESP123, #POL123
-        r'^LL\d+',           # LL15278 (Espanha)
-        r'^[A-Z]{2}\d+',     # Outros códigos de país
-        r'^\d+[A-Z]+',       # Números seguidos de letras
-    ]
-    
-    for pattern in valid_patterns:
-        if re.match(pattern, order_str):
-            return True
-    
+
+    # Padrões válidos conhecidos (#ITA123, LL15278, XX123, 123AB)
+    if REGEX_PEDIDO_CONHECIDO.match(order_str):
+        return True
+
     # Se não matchou padrões específicos, aceitar se tem formato alfanumérico básico
     # e não é obviamente inválido
-    if re.match(r'^[A-Za-z0-9#\-_]+$', order_str) and len(order_str) >= 3:
-        return True
-    
-    return False
+    return bool(REGEX_PEDIDO_BASICO.match(order_str))
+
+# Mapeamento das colunas do relatório N1 para o schema do banco
+COLUMN_MAPPING_N1 = {
+    'Order #': 'order_number',
+    'Shipping #': 'shipping_number',
+    'Completed date': 'completed_date',
+    'Customer': 'customer',
+    'Payment': 'payment',
+    'Sku': 'sku',
+    'Product name': 'product_name',
+    'Total revenues': 'total_revenues',
+    'Quantity': 'quantity',
+    'Product cost': 'product_cost',
+    'Order status': 'order_status',
+    'Last tracking': 'last_tracking',
+    'Last tracking date': 'last_tracking_date',
+    'Platform': 'platform',
+    'Zip': 'zip_code',
+    'Province code': 'province_code'
+}
+
+# Dtypes das colunas de texto do Excel; pula a inferência célula a célula e
+# evita que CEPs virem float. Datas e numéricos ficam de fora de propósito:
+# o parse deles acontece em processar_dados_n1
+EXCEL_DTYPES_N1 = {
+    'Order #': 'string',
+    'Shipping #': 'string',
+    'Customer': 'string',
+    'Payment': 'string',
+    'Sku': 'string',
+    'Product name': 'string',
+    'Order status': 'string',
+    'Last tracking': 'string',
+    'Platform': 'string',
+    'Zip': 'string',
+    'Province code': 'string',
+}
+
+def ler_excel_n1(uploaded_file):
+    """Lê o Excel da N1 com o engine mais rápido disponível"""
+    try:
+        # calamine (Rust) é bem mais rápido e usa menos memória que o openpyxl
+        try:
+            # Ler apenas as colunas mapeadas poupa parsing e memória
+            return pd.read_excel(uploaded_file, engine='calamine',
+                                 usecols=list(COLUMN_MAPPING_N1.keys()),
+                                 dtype=EXCEL_DTYPES_N1)
+        except ValueError:
+            # Cabeçalho fora do padrão (ex.: deslocado) - ler o arquivo completo
+            uploaded_file.seek(0)
+            return pd.read_excel(uploaded_file, engine='calamine', dtype=EXCEL_DTYPES_N1)
+    except ImportError:
+        pass
+
+    # Fallback: openpyxl em modo read-only transmite as linhas sem montar o DOM inteiro
+    uploaded_file.seek(0)
+    try:
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+        try:
+            linhas = workbook[workbook.sheetnames[0]].iter_rows(values_only=True)
+            header = next(linhas, None)
+            if header is not None:
+                return pd.DataFrame(linhas, columns=list(header))
+        finally:
+            workbook.close()
+    except Exception:
+        pass
+
+    # Último recurso (ex.: arquivos .xls): leitor padrão do pandas
+    uploaded_file.seek(0)
+    return pd.read_excel(uploaded_file, dtype=EXCEL_DTYPES_N1)
 
 def processar_dados_n1(df, pais_manual=None):
     """Processa dados do Excel da N1"""
     try:
-        df_clean = df.copy()
-        
+        # Sem cópia defensiva: o frame de entrada só é reatribuído, nunca mutado in place
+        df_clean = df
+
         # Log inicial
         print(f"DataFrame inicial: {len(df_clean)} linhas x {len(df_clean.columns)} colunas")
         
         # Remover primeira linha se for header duplicado
-        if len(df_clean) > 0 and not str(df_clean.iloc[0, 0]).startswith(('#', 'LL')):
-            primeira_linha = str(df_clean.iloc[0, 0]).strip()
-            if primeira_linha.lower() in ['order #', 'order', 'número pedido'] or primeira_linha == '':
+        if len(df_clean) > 0 and not str(df_clean.iat[0, 0]).startswith(('#', 'LL')):
+            if str(df_clean.iat[0, 0]).strip().lower() in HEADER_TOKENS:
                 df_clean = df_clean.iloc[1:].reset_index(drop=True)
                 print(f"Removida primeira linha (header duplicado). Agora: {len(df_clean)} linhas")
-        
+
         # Remover última linha se contiver "Total"
         if len(df_clean) > 1:
-            last_row = df_clean.iloc[-1]
-            last_row_str = ' '.join([str(val) for val in last_row if pd.notna(val)]).lower()
-            if 'total' in last_row_str:
+            last_row = df_clean.iloc[-1].astype('string')
+            if last_row.str.contains('total', case=False, na=False).any():
                 df_clean = df_clean.iloc[:-1].reset_index(drop=True)
                 print(f"Removida última linha (total). Agora: {len(df_clean)} linhas")
         
-        # Mapeamento das colunas
-        column_mapping = {
-            'Order #': 'order_number',
-            'Shipping #': 'shipping_number', 
-            'Completed date': 'completed_date',
-            'Customer': 'customer',
-            'Payment': 'payment',
-            'Sku': 'sku',
-            'Product name': 'product_name',
-            'Total revenues': 'total_revenues',
-            'Quantity': 'quantity',
-            'Product cost': 'product_cost',
-            'Order status': 'order_status',
-            'Last tracking': 'last_tracking',
-            'Last tracking date': 'last_tracking_date',
-            'Platform': 'platform',
-            'Zip': 'zip_code',
-            'Province code': 'province_code'
-        }
-        
         # Filtrar colunas existentes
-        available_columns = {k: v for k, v in column_mapping.items() if k in df_clean.columns}
-        missing_columns = [k for k in column_mapping.keys() if k not in df_clean.columns]
+        available_columns = {k: v for k, v in COLUMN_MAPPING_N1.items() if k in df_clean.columns}
+        missing_columns = [k for k in COLUMN_MAPPING_N1.keys() if k not in df_clean.columns]
         
         if missing_columns:
             print(f"Colunas não encontradas: {missing_columns}")
         
-        df_processed = df_clean[list(available_columns.keys())].copy()
-        df_processed = df_processed.rename(columns=available_columns)
+        # A seleção de colunas já materializa um frame novo; rename só troca os rótulos
+        df_processed = df_clean[list(available_columns.keys())].rename(columns=available_columns)
         
         print(f"Após mapeamento de colunas: {len(df_processed)} linhas")
         
         # Limpar dados inválidos - VERSÃO CORRIGIDA
         if 'order_number' in df_processed.columns:
-            # Remover valores nulos ou vazios
+            # Limpeza e validação em uma máscara só: um único slice do frame
             inicial_count = len(df_processed)
-            df_processed = df_processed[df_processed['order_number'].notna()]
-            df_processed = df_processed[df_processed['order_number'].astype(str).str.strip() != '']
-            
-            print(f"Após remover nulos/vazios: {len(df_processed)} linhas (removidos: {inicial_count - len(df_processed)})")
-            
-            # Usar nova função de validação mais flexível
-            valid_mask = df_processed['order_number'].apply(is_valid_order_number)
-            df_processed = df_processed[valid_mask]
-            
+            order_str = df_processed['order_number'].astype(str).str.strip()
+            mask_preenchido = df_processed['order_number'].notna() & (order_str != '')
+
+            apos_vazios = int(mask_preenchido.sum())
+            print(f"Após remover nulos/vazios: {apos_vazios} linhas (removidos: {inicial_count - apos_vazios})")
+
+            # Validação vetorizada (mesmas regras de is_valid_order_number, que
+            # segue em uso no caminho de debug da interface)
+            valid_mask = (
+                mask_preenchido
+                & order_str.str.len().ge(3)
+                & order_str.str.contains(REGEX_LETRA, na=False)
+                & order_str.str.contains(REGEX_NUMERO, na=False)
+                & (order_str.str.match(REGEX_PEDIDO_CONHECIDO, na=False)
+                   | order_str.str.match(REGEX_PEDIDO_BASICO, na=False))
+            )
+            df_processed = df_processed.loc[valid_mask].reset_index(drop=True)
+
             print(f"Após validação de pedidos: {len(df_processed)} linhas")
             
             # Mostrar exemplos de pedidos aceitos
@@ -208,29 +305,29 @@ def processar_dados_n1(df, pais_manual=None):
             raise ValueError("Nenhum pedido válido encontrado após filtros. Verifique o formato dos números de pedidos.")
         
         # Processar datas
+        # Manter datetime64 até o insert: o driver envia timestamp nativo, sem
+        # formatar para string aqui e reparsear no banco
         if 'completed_date' in df_processed.columns:
-            df_processed['completed_date'] = pd.to_datetime(df_processed['completed_date'], format='%d/%m/%Y %H:%M', errors='coerce')
-            df_processed['completed_date'] = df_processed['completed_date'].apply(
-                lambda x: x.strftime('%Y-%m-%d %H:%M:%S') if pd.notna(x) else None
-            )
-        
+            df_processed['completed_date'] = pd.to_datetime(
+                df_processed['completed_date'], format='%d/%m/%Y %H:%M', errors='coerce', cache=True)
+
         if 'last_tracking_date' in df_processed.columns:
-            df_processed['last_tracking_date'] = pd.to_datetime(df_processed['last_tracking_date'], format='%d/%m/%Y', errors='coerce')
-            df_processed['last_tracking_date'] = df_processed['last_tracking_date'].apply(
-                lambda x: x.strftime('%Y-%m-%d') if pd.notna(x) else None
-            )
+            df_processed['last_tracking_date'] = pd.to_datetime(
+                df_processed['last_tracking_date'], format='%d/%m/%Y', errors='coerce', cache=True)
         
-        # Processar tipos numéricos
+        # Processar tipos numéricos (quantity aceita o menor inteiro que couber;
+        # valores monetários ficam em float64 para não perder precisão)
         numeric_columns = ['total_revenues', 'quantity', 'product_cost']
         for col in numeric_columns:
             if col in df_processed.columns:
-                df_processed[col] = pd.to_numeric(df_processed[col], errors='coerce')
+                downcast = 'integer' if col == 'quantity' else None
+                df_processed[col] = pd.to_numeric(df_processed[col], errors='coerce', downcast=downcast)
         
-        # Processar strings (não datas)
+        # Processar strings (não datas) - dtype string preserva NA em vez de gerar 'nan'
         string_columns = ['zip_code', 'province_code', 'customer', 'payment', 'sku', 'last_tracking', 'platform']
         for col in string_columns:
             if col in df_processed.columns:
-                df_processed[col] = df_processed[col].astype(str).replace('nan', '')
+                df_processed[col] = df_processed[col].astype('string').fillna('')
         
         # Preencher apenas campos de texto com strings vazias
         text_columns = ['order_number', 'shipping_number', 'customer', 'payment', 'sku', 
@@ -240,59 +337,107 @@ def processar_dados_n1(df, pais_manual=None):
             if col in df_processed.columns:
                 df_processed[col] = df_processed[col].fillna('')
         
-        # Identificar país - VERSÃO MELHORADA
-        def identificar_pais(row):
-            # Se país foi especificado manualmente, usar esse
-            if pais_manual:
-                return pais_manual
-            
-            # Tentar detectar pelo número do pedido
-            pais_pedido = detectar_pais_por_pedido(row.get('order_number'))
-            if pais_pedido:
-                return pais_pedido
-            
+        # Identificar país - vetorizado (sem apply por linha)
+        if pais_manual:
+            df_processed['pais'] = pais_manual
+        else:
+            # Detecção pelo número do pedido: as mesmas tabelas de prefixo do
+            # caminho escalar, aplicadas por fatia de tamanho fixo
+            order_upper = df_processed['order_number'].astype(str).str.strip().str.upper()
+            pais_pedido = (
+                order_upper.str[:4].map(PREFIXO_PAIS_4)
+                .fillna(order_upper.str[:3].map(PREFIXO_PAIS_3))
+                .fillna(order_upper.str[:2].map(PREFIXO_PAIS_2))
+                .fillna('')
+            )
+
             # Fallback: analisar código de província e CEP
-            province_code = str(row.get('province_code', '')).upper().strip()
-            zip_code = str(row.get('zip_code', '')).strip()
-            
-            # Códigos de província da Espanha (2 letras)
-            spain_provinces = ['A', 'AB', 'AL', 'AV', 'B', 'BA', 'BI', 'BU', 'C', 'CA', 'CC', 'CO', 'CR', 'CS', 'CU', 'GC', 'GI', 'GR', 'GU', 'H', 'HU', 'J', 'L', 'LE', 'LO', 'LU', 'M', 'MA', 'MU', 'NA', 'O', 'OR', 'P', 'PM', 'PO', 'S', 'SA', 'SE', 'SG', 'SO', 'SS', 'T', 'TE', 'TF', 'TO', 'V', 'VA', 'VI', 'Z', 'ZA']
-            
-            if province_code in spain_provinces:
-                return 'Espanha'
-            
-            # Códigos de província da Itália (2 letras)
-            if len(province_code) == 2 and province_code.isalpha() and province_code not in spain_provinces:
-                return 'Italia'
-            
-            # Análise por CEP
-            if zip_code and zip_code != '' and zip_code.isdigit():
-                if len(zip_code) == 5:
-                    # CEPs de 5 dígitos podem ser Itália ou Espanha
-                    # Vamos usar outros indicadores
-                    if province_code in spain_provinces:
-                        return 'Espanha'
-                    return 'Italia'
-                elif len(zip_code) == 6:
-                    return 'Romania'
-            
-            # Default: Italia (para compatibilidade)
-            return 'Italia'
-        
-        df_processed['pais'] = df_processed.apply(identificar_pais, axis=1)
+            if 'province_code' in df_processed.columns:
+                province = df_processed['province_code'].astype(str).str.upper().str.strip()
+            else:
+                province = pd.Series('', index=df_processed.index)
+
+            if 'zip_code' in df_processed.columns:
+                zip_code = df_processed['zip_code'].astype(str).str.strip()
+            else:
+                zip_code = pd.Series('', index=df_processed.index)
+
+            zip_digit = zip_code.str.isdigit()
+            pais_fallback = np.select(
+                [
+                    province.isin(SPAIN_PROVINCES),
+                    (province.str.len() == 2) & province.str.isalpha(),
+                    zip_digit & (zip_code.str.len() == 5),
+                    zip_digit & (zip_code.str.len() == 6),
+                ],
+                ['Espanha', 'Italia', 'Italia', 'Romania'],
+                default='Italia'  # Default: Italia (para compatibilidade)
+            )
+
+            df_processed['pais'] = np.where(pais_pedido != '', pais_pedido, pais_fallback)
         
         print(f"Países detectados: {df_processed['pais'].value_counts().to_dict()}")
-        
+
+        # Colunas de baixa cardinalidade como category (menos memória, groupby mais rápido)
+        category_columns = ['product_name', 'order_status', 'platform', 'payment', 'province_code', 'pais', 'last_tracking']
+        for col in category_columns:
+            if col in df_processed.columns:
+                df_processed[col] = df_processed[col].astype('category')
+
         return df_processed
         
     except Exception as e:
         print(f"Erro em processar_dados_n1: {str(e)}")
         raise e
 
+# Tipos SQL das colunas de dados_n1 (espelham o DDL de criar_tabelas);
+# passados ao to_sql para pular a inferência de tipos a cada upload
+DADOS_N1_SQL_TYPES = {
+    'upload_id': types.Integer(),
+    'order_number': types.String(50),
+    'shipping_number': types.String(100),
+    'completed_date': types.TIMESTAMP(),
+    'customer': types.String(255),
+    'payment': types.String(50),
+    'sku': types.String(100),
+    'product_name': types.String(255),
+    'total_revenues': types.Numeric(10, 2),
+    'quantity': types.Integer(),
+    'product_cost': types.Numeric(10, 2),
+    'order_status': types.String(50),
+    'last_tracking': types.String(255),
+    'last_tracking_date': types.Date(),
+    'platform': types.String(50),
+    'zip_code': types.String(20),
+    'province_code': types.String(10),
+    'pais': types.String(20),
+}
+
+def psql_insert_copy(table, conn, keys, data_iter):
+    """Insere linhas em lote via COPY FROM STDIN (caminho de ingestão mais rápido do Postgres)"""
+    colunas = ', '.join(keys)
+
+    with conn.connection.cursor() as cur:
+        if not hasattr(cur, 'copy_expert'):
+            # Driver sem COPY: executemany em lote (o engine agrupa em multi-VALUES)
+            placeholders = ', '.join(['%s'] * len(keys))
+            cur.executemany(f"INSERT INTO {table.name} ({colunas}) VALUES ({placeholders})",
+                            list(data_iter))
+            return
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(data_iter)
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table.name} ({colunas}) FROM STDIN WITH CSV", buffer)
+
 def salvar_dados_n1(df, nome_personalizado, engine):
     """Salva dados da N1 no banco"""
     try:
         with engine.begin() as conn:
+            # Pular o fsync do WAL durante a carga: a transação é única, então
+            # uma queda perderia no máximo este upload inteiro
+            conn.execute(text("SET LOCAL synchronous_commit = off"))
+
             # Calcular período
             periodo_inicio = None
             periodo_fim = None
@@ -315,59 +460,51 @@ def salvar_dados_n1(df, nome_personalizado, engine):
                 'total_registros': len(df)
             }
             
-            result = conn.execute(text("""
+            # Um único round-trip para criar o upload e obter o id
+            upload_id = conn.execute(text("""
                 INSERT INTO uploads_n1 (nome_arquivo, periodo_inicio, periodo_fim, total_registros)
                 VALUES (:nome_arquivo, :periodo_inicio, :periodo_fim, :total_registros)
                 RETURNING id
-            """), upload_data)
-            
-            upload_id = result.fetchone()[0]
-            
-            # Salvar dados
-            df_copy = df.copy()
-            df_copy['upload_id'] = upload_id
-            
-            # Para arquivos grandes, usar chunks menores
-            chunk_size = 100 if len(df_copy) > 500 else 500
-            
-            # Inserir em chunks para evitar timeout e problemas de memória
-            total_chunks = (len(df_copy) // chunk_size) + (1 if len(df_copy) % chunk_size > 0 else 0)
-            
-            for i in range(0, len(df_copy), chunk_size):
-                chunk = df_copy.iloc[i:i + chunk_size]
-                chunk.to_sql('dados_n1', conn, if_exists='append', index=False)
-                
-                # Mostrar progresso para arquivos grandes
-                if total_chunks > 1:
-                    chunk_num = (i // chunk_size) + 1
-                    print(f"Processando chunk {chunk_num}/{total_chunks} ({len(chunk)} registros)")
+            """), upload_data).scalar_one()
             
+            # Salvar dados via COPY (um payload CSV em stream em vez de INSERTs);
+            # assign compartilha as colunas existentes em vez de copiar tudo
+            df_copy = df.assign(upload_id=upload_id)
+
+            df_copy.to_sql('dados_n1', conn, if_exists='append', index=False,
+                           chunksize=50000, method=psql_insert_copy,
+                           dtype=DADOS_N1_SQL_TYPES)
+
             return upload_id
             
     except Exception as e:
         raise e
 
-def carregar_uploads_n1(engine):
+@st.cache_data(ttl=300, show_spinner=False)
+def carregar_uploads_n1(_engine):
     """Carrega lista de uploads da N1"""
     query = """
         SELECT id, nome_arquivo, periodo_inicio, periodo_fim, data_upload, total_registros
-        FROM uploads_n1 
+        FROM uploads_n1
         ORDER BY data_upload DESC
     """
-    return pd.read_sql(query, engine)
+    return pd.read_sql(query, _engine)
 
-def carregar_dados_n1(upload_id, pais_filtro, engine):
+@st.cache_data(ttl=300, show_spinner=False)
+def carregar_dados_n1(upload_id, pais_filtro, _engine):
     """Carrega dados da N1 para análise"""
     upload_id = int(upload_id)
-    
-    query = "SELECT * FROM dados_n1 WHERE upload_id = %(upload_id)s"
-    params = {'upload_id': upload_id}
-    
-    if pais_filtro != 'Todos':
-        query += " AND pais = %(pais)s"
-        params['pais'] = pais_filtro
-    
-    df = pd.read_sql(query, engine, params=params)
+
+    # Um único texto SQL para os dois casos: o plano fica cacheado no servidor
+    query = """
+        SELECT * FROM dados_n1
+        WHERE upload_id = %(upload_id)s
+          AND (%(pais)s = 'Todos' OR pais = %(pais)s)
+    """
+    params = {'upload_id': upload_id, 'pais': pais_filtro}
+
+    # Backend pyarrow: strings ficam em buffers contíguos em vez de um objeto Python por célula
+    df = pd.read_sql(query, _engine, params=params, dtype_backend='pyarrow')
     
     # Converter datas
     if 'completed_date' in df.columns:
@@ -375,38 +512,103 @@ def carregar_dados_n1(upload_id, pais_filtro, engine):
     
     if 'last_tracking_date' in df.columns:
         df['last_tracking_date'] = pd.to_datetime(df['last_tracking_date'], errors='coerce')
-    
+
+    # Mesmo tratamento de category do processar_dados_n1
+    for col in ['product_name', 'order_status', 'platform', 'payment', 'province_code', 'pais', 'last_tracking']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
     return df
 
+# Compilada uma vez no import; reutilizada a cada troca de país
+CONTAGEM_POR_PAIS_SQL = text("""
+    SELECT upload_id, COUNT(*) AS total
+    FROM dados_n1
+    WHERE pais = :pais
+    GROUP BY upload_id
+""")
+
+@st.cache_data(ttl=300, show_spinner=False)
+def contar_registros_por_pais(pais, _engine):
+    """Conta registros por upload para um país em uma única query agrupada"""
+    df = pd.read_sql(CONTAGEM_POR_PAIS_SQL, _engine, params={'pais': pais})
+    return dict(zip(df['upload_id'], df['total']))
+
 def calcular_metricas_n1(df):
     """Calcula métricas por produto"""
     if df.empty:
         return pd.DataFrame()
     
-    # Agrupar por produto
-    metricas = df.groupby('product_name').agg({
-        'order_number': 'count',
-        'shipping_number': 'count',
-    }).reset_index()
-    
-    metricas.columns = ['Product', 'Pedidos Totais', 'Pedidos Enviados']
-    
-    # Calcular entregues e devoluções
-    status_counts = df.groupby(['product_name', 'order_status']).size().unstack(fill_value=0)
-    
-    entregues = status_counts.get('Delivered', pd.Series(0, index=status_counts.index))
-    devolucoes = status_counts.get('Return', pd.Series(0, index=status_counts.index)) + \
-                status_counts.get('Returned', pd.Series(0, index=status_counts.index))
-    
-    metricas['Entregues'] = metricas['Product'].map(entregues).fillna(0).astype(int)
-    metricas['Devoluções'] = metricas['Product'].map(devolucoes).fillna(0).astype(int)
+    # Agrupar por produto em uma única passada (contagens + status juntos)
+    status = df['order_status']
+    metricas = df.assign(
+        _entregue=status.eq('Delivered').astype(int),
+        _devolucao=status.isin(['Return', 'Returned']).astype(int),
+    ).groupby('product_name', observed=True).agg(**{
+        'Pedidos Totais': ('order_number', 'count'),
+        'Pedidos Enviados': ('shipping_number', 'count'),
+        'Entregues': ('_entregue', 'sum'),
+        'Devoluções': ('_devolucao', 'sum'),
+    }).reset_index().rename(columns={'product_name': 'Product'})
+
     metricas['Shipping'] = metricas['Pedidos Enviados']
-    
+
     # Calcular efetividade
     metricas['Efetividade'] = (metricas['Entregues'] / metricas['Pedidos Totais'] * 100).round(2)
-    
+
     return metricas
 
+@st.cache_data(ttl=300, show_spinner=False)
+def carregar_metricas_n1(upload_id, pais_filtro, _engine):
+    """Calcula métricas por produto direto no banco (agregação no Postgres)"""
+    upload_id = int(upload_id)
+
+    query = """
+        SELECT product_name AS "Product",
+               COUNT(order_number) AS "Pedidos Totais",
+               COUNT(shipping_number) AS "Pedidos Enviados",
+               SUM(CASE WHEN order_status = 'Delivered' THEN 1 ELSE 0 END) AS "Entregues",
+               SUM(CASE WHEN order_status IN ('Return', 'Returned') THEN 1 ELSE 0 END) AS "Devoluções"
+        FROM dados_n1
+        WHERE upload_id = %(upload_id)s
+          AND (%(pais)s = 'Todos' OR pais = %(pais)s)
+          AND product_name <> ''
+        GROUP BY product_name
+        HAVING COUNT(order_number) > 0
+        ORDER BY "Pedidos Totais" DESC
+    """
+    metricas = pd.read_sql(query, _engine, params={'upload_id': upload_id, 'pais': pais_filtro})
+
+    if metricas.empty:
+        return metricas
+
+    # Strings Arrow: buffers UTF-8 contíguos, sem um PyObject por célula
+    metricas['Product'] = metricas['Product'].astype('string[pyarrow]')
+
+    # Encolher os dtypes: as contagens cabem em inteiros menores que int64
+    for col in ['Pedidos Totais', 'Pedidos Enviados', 'Entregues', 'Devoluções']:
+        metricas[col] = pd.to_numeric(metricas[col], downcast='unsigned')
+
+    metricas['Shipping'] = metricas['Pedidos Enviados']
+
+    # Calcular efetividade
+    metricas['Efetividade'] = (metricas['Entregues'] / metricas['Pedidos Totais'] * 100).round(2).astype('float32')
+
+    # Totais pré-computados para os cartões de KPI (leitura O(1) no painel)
+    metricas.attrs['tot_pedidos'] = int(metricas['Pedidos Totais'].sum())
+    metricas.attrs['tot_entregues'] = int(metricas['Entregues'].sum())
+    metricas.attrs['tot_devolucoes'] = int(metricas['Devoluções'].sum())
+
+    return metricas
+
+@st.cache_data(ttl=300, show_spinner=False)
+def gerar_csv_metricas_n1(upload_id, pais_filtro, _engine):
+    """Gera o CSV do relatório de métricas, cacheado por (upload, país)"""
+    metricas = carregar_metricas_n1(upload_id, pais_filtro, _engine)
+    buffer = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(metricas, preserve_index=False), buffer)
+    return buffer.getvalue()
+
 def excluir_upload_n1(upload_id, engine):
     """Exclui upload N1 e seus dados"""
     try:
@@ -420,27 +622,30 @@ def excluir_upload_n1(upload_id, engine):
         st.error(f"Erro ao excluir: {str(e)}")
         return False
 
+# Faixas e estilos da coluna Efetividade (construídos uma vez por processo)
+FAIXAS_EFETIVIDADE = (60, 50, 40)
+CORES_EFETIVIDADE = (
+    'background-color: #28a745; color: white',  # Verde escuro
+    'background-color: #6bc950; color: white',  # Verde claro
+    'background-color: #ffc107; color: black',  # Amarelo
+)
+COR_EFETIVIDADE_BAIXA = 'background-color: #dc3545; color: white'  # Vermelho
+FORMATO_EFETIVIDADE = {'Efetividade': '{:.2f}%'}
+
 def aplicar_cores_efetividade(df):
     """Aplica cores na coluna de efetividade"""
-    def color_efetividade(val):
-        if pd.isna(val):
-            return ''
-        try:
-            # Remover % e converter para float
-            num_val = float(str(val).replace('%', ''))
-            if num_val >= 60:
-                return 'background-color: #28a745; color: white'  # Verde escuro
-            elif num_val >= 50:
-                return 'background-color: #6bc950; color: white'  # Verde claro
-            elif num_val >= 40:
-                return 'background-color: #ffc107; color: black'  # Amarelo
-            else:
-                return 'background-color: #dc3545; color: white'  # Vermelho
-        except:
-            return ''
-    
-    # Aplicar estilo apenas na coluna Efetividade
-    return df.style.applymap(color_efetividade, subset=['Efetividade'])
+    def color_efetividade(col):
+        # Converter a coluna inteira de uma vez (aceita float ou "xx.xx%")
+        valores = pd.to_numeric(col.astype(str).str.replace('%', '', regex=False), errors='coerce')
+        estilos = np.select(
+            [valores >= faixa for faixa in FAIXAS_EFETIVIDADE],
+            CORES_EFETIVIDADE,
+            default=COR_EFETIVIDADE_BAIXA
+        )
+        return np.where(valores.notna(), estilos, '')
+
+    # Formatar o percentual na renderização e aplicar estilo apenas na coluna Efetividade
+    return df.style.format(FORMATO_EFETIVIDADE).apply(color_efetividade, subset=['Efetividade'])
 
 # Dashboard N1
 def dashboard_n1(engine):
@@ -449,7 +654,11 @@ def dashboard_n1(engine):
     # Session state para controlar upload
     if 'upload_success_n1' not in st.session_state:
         st.session_state.upload_success_n1 = False
-    
+
+    # Carregar a lista de uploads uma vez por render (usada na sidebar e na análise)
+    uploads = carregar_uploads_n1(engine)
+
+
     # Sidebar para upload
     with st.sidebar:
         st.subheader("📁 Upload de Dados N1")
@@ -483,7 +692,7 @@ def dashboard_n1(engine):
         
         if uploaded_file is not None and nome_personalizado.strip():
             try:
-                df_raw = pd.read_excel(uploaded_file)
+                df_raw = ler_excel_n1(uploaded_file)
                 
                 # Passar país manual para processamento
                 pais_para_processar = pais_manual if pais_manual != 'Automático' else None
@@ -599,8 +808,6 @@ def dashboard_n1(engine):
         
         # Seção de exclusão
         st.subheader("🗑️ Excluir Dados N1")
-        uploads = carregar_uploads_n1(engine)
-        
         if not uploads.empty:
             upload_para_excluir = st.selectbox(
                 "Selecione upload para excluir:",
@@ -627,13 +834,16 @@ def dashboard_n1(engine):
     
     # Área principal - análise
     st.subheader("📊 Análise de Dados N1")
-    
-    uploads = carregar_uploads_n1(engine)
-    
+
     if uploads.empty:
         st.info("📤 Faça upload de um arquivo na barra lateral para começar.")
         return
-    
+
+    painel_analise_n1(uploads, engine)
+
+@st.fragment
+def painel_analise_n1(uploads, engine):
+    """Painel de análise; como fragment, os widgets daqui rerodam só este bloco"""
     # Seletor de País
     pais_selecionado = st.selectbox(
         "Selecione o país:", 
@@ -642,22 +852,13 @@ def dashboard_n1(engine):
         key="pais_n1"
     )
     
-    # Filtrar uploads por país
+    # Filtrar uploads por país (uma query agrupada em vez de COUNT por upload)
     if pais_selecionado == "Todos":
+        contagem_pais = {}
         uploads_filtrados = uploads
     else:
-        uploads_com_pais = []
-        for _, upload in uploads.iterrows():
-            with engine.connect() as conn:
-                count_pais = conn.execute(
-                    text("SELECT COUNT(*) FROM dados_n1 WHERE upload_id = :upload_id AND pais = :pais"),
-                    {'upload_id': upload['id'], 'pais': pais_selecionado}
-                ).fetchone()[0]
-                
-                if count_pais > 0:
-                    uploads_com_pais.append(upload['id'])
-        
-        uploads_filtrados = uploads[uploads['id'].isin(uploads_com_pais)]
+        contagem_pais = contar_registros_por_pais(pais_selecionado, engine)
+        uploads_filtrados = uploads[uploads['id'].isin(contagem_pais.keys())]
     
     if uploads_filtrados.empty:
         st.warning(f"⚠️ Nenhum upload encontrado com dados de {pais_selecionado}.")
@@ -676,71 +877,66 @@ def dashboard_n1(engine):
         if pais_selecionado == "Todos":
             registros_info = f"{row['total_registros']} registros"
         else:
-            with engine.connect() as conn:
-                count_pais = conn.execute(
-                    text("SELECT COUNT(*) FROM dados_n1 WHERE upload_id = :upload_id AND pais = :pais"),
-                    {'upload_id': row['id'], 'pais': pais_selecionado}
-                ).fetchone()[0]
-                registros_info = f"{count_pais} registros ({pais_selecionado})"
+            registros_info = f"{contagem_pais.get(row['id'], 0)} registros ({pais_selecionado})"
         
         upload_options.append(f"{row['nome_arquivo']} {periodo} - {registros_info}")
     
     upload_selecionado = st.selectbox("Selecione o período para análise:", upload_options, key="periodo_n1")
     upload_id = int(uploads_filtrados.iloc[upload_options.index(upload_selecionado)]['id'])
     
-    # Carregar e analisar dados
-    dados = carregar_dados_n1(upload_id, pais_selecionado, engine)
-    
-    if dados.empty:
+    # Calcular métricas direto no banco (só as linhas por produto trafegam)
+    metricas = carregar_metricas_n1(upload_id, pais_selecionado, engine)
+
+    if metricas.empty:
         st.warning("⚠️ Nenhum dado encontrado para os filtros selecionados.")
         return
     
-    # Calcular métricas
-    metricas = calcular_metricas_n1(dados)
-    
-    # Filtrar produtos válidos
-    metricas = metricas[metricas['Product'] != '']
-    metricas = metricas[metricas['Pedidos Totais'] > 0]
-    
-    # Métricas principais
+    # Métricas principais (produtos válidos e totais já resolvidos na query)
+    total_pedidos = metricas.attrs['tot_pedidos']
+    total_entregues = metricas.attrs['tot_entregues']
+    total_devolucoes = metricas.attrs['tot_devolucoes']
     col1, col2, col3, col4 = st.columns(4)
-    
+
     with col1:
-        st.metric("Total de Pedidos", metricas['Pedidos Totais'].sum())
-    
+        st.metric("Total de Pedidos", total_pedidos)
+
     with col2:
-        st.metric("Total Entregues", metricas['Entregues'].sum())
-    
+        st.metric("Total Entregues", total_entregues)
+
     with col3:
-        st.metric("Total Devoluções", metricas['Devoluções'].sum())
-    
+        st.metric("Total Devoluções", total_devolucoes)
+
     with col4:
-        efetividade_geral = (metricas['Entregues'].sum() / metricas['Pedidos Totais'].sum() * 100) if metricas['Pedidos Totais'].sum() > 0 else 0
+        efetividade_geral = (total_entregues / total_pedidos * 100) if total_pedidos > 0 else 0
         st.metric("Efetividade Geral", f"{efetividade_geral:.2f}%")
     
     # Tabela com cores
     st.subheader("📋 Tabela de Efetividade por Produto")
     
-    df_display = metricas.copy()
-    df_display['Efetividade'] = df_display['Efetividade'].apply(lambda x: f"{x:.2f}%")
-    
-    # Aplicar cores e exibir
-    styled_df = aplicar_cores_efetividade(df_display)
+    # Limitar o que vai ao navegador: a query já ordena por pedidos,
+    # então os maiores produtos são um head() sem novo sort
+    tabela = metricas
+    if len(metricas) > 200 and not st.checkbox("Mostrar todos os produtos", key="mostrar_todos_n1"):
+        tabela = metricas.head(200)
+        st.caption(f"Exibindo os 200 produtos com mais pedidos (de {len(metricas)}).")
+
+    # Aplicar cores e exibir (o Styler formata o percentual; a coluna segue numérica)
+    styled_df = aplicar_cores_efetividade(tabela)
     st.dataframe(styled_df, use_container_width=True, height=400)
     
-    # Download
+    # Download (CSV cacheado por upload/país, sem o clique intermediário)
+    # Timestamp fixado por sessão para o widget não mudar a cada rerun
+    ts_download = st.session_state.setdefault('download_ts_n1', datetime.now().strftime('%Y%m%d_%H%M%S'))
     col1, col2 = st.columns([3, 1])
     with col2:
-        if st.button("📥 Download CSV", use_container_width=True, key="download_n1"):
-            csv = metricas.to_csv(index=False)
-            st.download_button(
-                label="⬇️ Baixar Relatório",
-                data=csv,
-                file_name=f"relatorio_n1_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                mime="text/csv",
-                use_container_width=True,
-                key="download_btn_n1"
-            )
+        st.download_button(
+            label="📥 Download CSV",
+            data=gerar_csv_metricas_n1(upload_id, pais_selecionado, engine),
+            file_name=f"relatorio_n1_{ts_download}.csv",
+            mime="text/csv",
+            use_container_width=True,
+            key="download_btn_n1"
+        )
 
 # Dashboard Prime COD
 def dashboard_prime_cod():